@@ -3,21 +3,77 @@ import os
 import sys
 import argparse
 import requests
-import pathlib
 import hashlib
 import uuid
 import logging
 import json
+import signal
+import threading
 import time
+import contextlib
 import datetime
+import itertools
 from typing import List
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from operator import itemgetter
 from platform import release
 import logging as log
 from pytimeparse.timeparse import timeparse
 import vsc
-from distutils.dir_util import create_tree
 from requests.adapters import HTTPAdapter, Retry
 
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+EXTENSION_NAME_BATCH_SIZE = 50
+# The malicious list is served with stray utf-8 nbsp characters
+_NBSP_TABLE = str.maketrans('', '', '\xa0')
+
+
+def download_file(url, destfile, session, sha256hash=None):
+    """
+    Stream a url to destfile in fixed size chunks rather than holding the whole body in memory.
+    The body is written to a hidden .part file and only moved into place once complete. If a previous attempt was
+    interrupted, the .part file is resumed with a Range request instead of downloading it all again.
+    If sha256hash is given the body is hashed as it streams, and it is discarded (returning False) on a mismatch.
+    """
+    # Hidden, so the gallery's vscode-<name>.* lookups never pick up an incomplete installer
+    partpath = os.path.join(os.path.dirname(destfile), f'.{os.path.basename(destfile)}.part')
+    h = hashlib.sha256() if sha256hash else None
+    offset = os.path.getsize(partpath) if os.path.exists(partpath) else 0
+    headers = {}
+    if offset:
+        # Ranges are offsets into the file itself, so ask for it without any transfer encoding
+        headers = {'Range': f'bytes={offset}-', 'Accept-Encoding': 'identity'}
+
+    with session.get(url, headers=headers, stream=True, allow_redirects=True, timeout=vsc.TIMEOUT) as result:
+        if offset and result.status_code == 416:
+            # The partial file no longer matches the remote file
+            restart = True
+        else:
+            restart = False
+            # Never store an error page in place of the artifact
+            result.raise_for_status()
+            if result.status_code != 206:
+                # Not a partial response, so the body is the whole file
+                offset = 0
+            if h and offset:
+                with open(partpath, 'rb') as existing:
+                    for chunk in iter(lambda: existing.read(DOWNLOAD_CHUNK_SIZE), b''):
+                        h.update(chunk)
+            with open(partpath, 'ab' if offset else 'wb') as dest:
+                for chunk in result.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    dest.write(chunk)
+                    if h:
+                        h.update(chunk)
+
+    if restart:
+        os.remove(partpath)
+        return download_file(url, destfile, session, sha256hash)
+    if h and h.hexdigest() != sha256hash:
+        os.remove(partpath)
+        return False
+    os.replace(partpath, destfile)
+    return True
+
 
 class VSCUpdateDefinition(object):
 
@@ -60,7 +116,7 @@ class VSCUpdateDefinition(object):
         self.supportsFastUpdate = supportsFastUpdate
         self.checkedForUpdate = False
 
-    def check_for_update(self, old_commit_id=None):
+    def check_for_update(self, session, old_commit_id=None):
         if not old_commit_id:
             # To trigger the API to delta
             old_commit_id = '7c4205b5c6e52a53b81c69d2b2dc8a627abaa0ba'
@@ -69,7 +125,7 @@ class VSCUpdateDefinition(object):
             f"{self.identity}/{self.quality}/{old_commit_id}"
 
         log.debug(f'Update url {url}')
-        result = requests.get(url, allow_redirects=True, timeout=vsc.TIMEOUT)
+        result = session.get(url, allow_redirects=True, timeout=vsc.TIMEOUT)
         self.checkedForUpdate = True
 
         if result.status_code == 204:
@@ -98,7 +154,7 @@ class VSCUpdateDefinition(object):
         else:
             return False
 
-    def download_update(self, destination):
+    def download_update(self, destination, session):
         if not self.checkedForUpdate:
             log.warning(
                 'Cannot download update if the update definition has not been downloaded')
@@ -109,40 +165,72 @@ class VSCUpdateDefinition(object):
             return
 
         destination = os.path.join(destination, self.identity, self.quality)
-        if not os.path.isdir(destination):
-            os.makedirs(destination)
-        suffix = pathlib.Path(self.updateurl).suffix
-        if '.gz' in suffix:
-            suffix = ''.join(pathlib.Path(self.updateurl).suffixes)
-        destfile = os.path.join(destination, f'vscode-{self.name}{suffix}')
+        os.makedirs(destination, exist_ok=True)
+        destfile = self._installer_path(destination)
 
         if os.path.exists(destfile) and vsc.Utility.hash_file_and_check(destfile, self.sha256hash):
             log.debug(f'Previously downloaded {self}')
         else:
             log.info(f'Downloading {self} to {destfile}')
-            result = requests.get(
-                self.updateurl, allow_redirects=True, timeout=vsc.TIMEOUT)
-            open(destfile, 'wb').write(result.content)
+            try:
+                # The hash is checked while streaming, so the installer is not read back from disk
+                hashok = download_file(self.updateurl, destfile, session, self.sha256hash)
+            except requests.exceptions.RequestException as err:
+                # Includes the RetryError raised once the adapter has exhausted its status retries
+                log.warning(f'Download failed for {self}: {err}')
+                return False
 
-            if not vsc.Utility.hash_file_and_check(destfile, self.sha256hash):
+            if not hashok:
                 log.warning(
                     f'HASH MISMATCH for {self} at {destfile} expected {self.sha256hash}. Removing local file.')
-                os.remove(destfile)
+                if os.path.exists(destfile):
+                    os.remove(destfile)
                 return False
             log.debug(f'Hash ok for {self} with {self.sha256hash}')
         return True
 
+    def is_current_on_disk(self, destination):
+        """
+        Check whether this exact update was already downloaded and verified by a previous sync.
+        latest.json is only saved after the installer's hash checked out, so a matching one can be trusted.
+        """
+        destination = os.path.join(destination, self.identity, self.quality)
+        latest = vsc.Utility.load_json(os.path.join(destination, 'latest.json'))
+        if not latest or latest.get('version') != self.version or latest.get('sha256hash') != self.sha256hash:
+            return False
+        return os.path.exists(self._installer_path(destination))
+
+    def _installer_path(self, destination):
+        return os.path.join(destination, f'vscode-{self.name}{self._url_suffix(self.updateurl)}')
+
+    @staticmethod
+    def _url_suffix(url):
+        """
+        The file extension of a url's last segment, keeping every suffix for .gz archives (e.g. .tar.gz).
+        Matches pathlib's suffix/suffixes without parsing the url as a path.
+        """
+        name = url.rsplit('/', 1)[-1]
+        if name.endswith('.'):
+            return ''
+        suffixes = name.lstrip('.').split('.')[1:]
+        if not suffixes:
+            return ''
+        if '.gz' in f'.{suffixes[-1]}':
+            return ''.join(f'.{suffix}' for suffix in suffixes)
+        return f'.{suffixes[-1]}'
+
     def save_state(self, destination):
         destination = os.path.join(destination, self.identity)
-        if not os.path.isdir(destination):
-            os.makedirs(destination)
+        os.makedirs(destination, exist_ok=True)
+        # All attributes are plain values, so serialise the blob once without the encoder hook
+        content = json.dumps(vars(self), indent=4)
         # Write version details blob as latest
-        vsc.Utility.write_json(os.path.join(
-            destination, self.quality, 'latest.json'), self)
+        vsc.Utility.write_if_changed(os.path.join(
+            destination, self.quality, 'latest.json'), content)
         # Write version details blob as the commit id
         if self.version:
-            vsc.Utility.write_json(os.path.join(
-                destination, self.quality, f'{self.version}.json'), self)
+            vsc.Utility.write_if_changed(os.path.join(
+                destination, self.quality, f'{self.version}.json'), content)
 
     def __repr__(self):
         strs = f"<{self.__class__.__name__}> {self.quality}/{self.identity}"
@@ -214,6 +302,9 @@ class VSCExtensionVersionDefinition:
 
 
 class VSCExtensionDefinition(object):
+    # Extension pack lists by manifest path, for the current sync cycle and the one before it
+    _extensionpacks = {}
+    _previousextensionpacks = {}
 
     def __init__(self, identity, raw=None):
         self.identity = identity
@@ -240,28 +331,41 @@ class VSCExtensionDefinition(object):
                     return
                 asset = file["assetType"]
                 destfile = os.path.join(ver_destination, f'{asset}')
-                create_tree(os.path.abspath(os.sep), (destfile,))
-                if not os.path.exists(destfile):
-                    for i in range(5):
-                        try:
-                            if i == 0:
-                                log.debug(f'Downloading {self.identity} {asset} to {destfile}')
-                            else:
-                                log.info(f'Retrying {i+1}, download {self.identity} {asset} to {destfile}')
-                            result = session.get(
-                                url, allow_redirects=True, timeout=vsc.TIMEOUT)
-                            with open(destfile, 'wb') as dest:
-                                dest.write(result.content)
-                            break
-                        except requests.exceptions.ProxyError:
-                            log.info("ProxyError: Retrying.")
-                        except requests.exceptions.ReadTimeout:
-                            log.info("ReadTimeout: Retrying.")
-
-    def process_embedded_extensions(self, destination, mp):
+                if os.path.exists(destfile):
+                    # Assets are stored per version and only moved into place once complete,
+                    # so an existing file is already current and needs no request at all
+                    continue
+                os.makedirs(ver_destination, exist_ok=True)
+                for i in range(5):
+                    try:
+                        if i == 0:
+                            log.debug(f'Downloading {self.identity} {asset} to {destfile}')
+                        else:
+                            log.info(f'Retrying {i+1}, download {self.identity} {asset} to {destfile}')
+                        download_file(url, destfile, session)
+                        break
+                    except (requests.exceptions.HTTPError, requests.exceptions.RetryError) as err:
+                        # Status retries are already handled by the session's adapter, which raises
+                        # RetryError once they are exhausted
+                        log.warning(f'Download failed for {self.identity} {asset}: {err}')
+                        break
+                    except requests.exceptions.ProxyError:
+                        log.info("ProxyError: Retrying.")
+                    except requests.exceptions.ReadTimeout:
+                        log.info("ReadTimeout: Retrying.")
+                    except requests.exceptions.ConnectionError:
+                        # Timeouts while streaming the body surface as a ConnectionError
+                        log.info("ConnectionError: Retrying.")
+                    except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ContentDecodingError):
+                        # The connection dropped mid-body, the next attempt resumes the partial file
+                        log.info("Incomplete body: Retrying.")
+
+    def process_embedded_extensions(self, destination, mp, known=None):
         """
         Check an extension's Manifest for an extension pack (e.g. more extensions to download)
+        Pack members found in known (lowercase identity to extension) are used without querying the marketplace.
         """
+        known = known or {}
         bonusextensions = []
         for version in self.versions:
             targetplatform = ''
@@ -269,49 +373,72 @@ class VSCExtensionDefinition(object):
                 targetplatform = version["targetPlatform"]
             manifestpath = os.path.join(
                 destination, self.identity, version["version"], targetplatform, 'Microsoft.VisualStudio.Code.Manifest')
-            manifest = vsc.Utility.load_json(manifestpath)
-            if manifest and 'extensionPack' in manifest:
-                for extname in manifest['extensionPack']:
-                    bonusextension = mp.search_by_extension_name(extname)
-                    if bonusextension:
-                        bonusextensions.append(bonusextension)
+            # Only cache manifests that exist, a missing one may still be downloaded by a later sync
+            if not os.path.exists(manifestpath):
+                continue
+            for extname in self._extension_pack(manifestpath):
+                bonusextension = known.get(extname.lower()) or mp.search_by_extension_name(extname)
+                if bonusextension:
+                    bonusextensions.append(bonusextension)
         return bonusextensions
 
+    @classmethod
+    def start_sync_cycle(cls):
+        """
+        Forget the pack lists of manifests that were not looked at during the last cycle, so a long running
+        sync only keeps those of the versions it is still syncing.
+        """
+        cls._previousextensionpacks = cls._extensionpacks
+        cls._extensionpacks = {}
+
+    @classmethod
+    def _extension_pack(cls, manifestpath):
+        """
+        The extension pack listed in a manifest. Manifests live in per-version folders and never change once
+        downloaded, so a manifest seen in the previous cycle is not parsed again.
+        """
+        pack = cls._extensionpacks.get(manifestpath)
+        if pack is None:
+            pack = cls._previousextensionpacks.get(manifestpath)
+            if pack is None:
+                manifest = vsc.Utility.load_json(manifestpath)
+                if isinstance(manifest, dict) and manifest.get('extensionPack'):
+                    pack = tuple(manifest['extensionPack'])
+                else:
+                    pack = ()
+            cls._extensionpacks[manifestpath] = pack
+        return pack
+
     def save_state(self, destination):
         destination = os.path.join(destination, self.identity)
-        if not os.path.isdir(destination):
-            os.makedirs(destination)
+        os.makedirs(destination, exist_ok=True)
+        # The definition only holds marketplace json, so serialise it once and reuse it for every copy
+        content = json.dumps(vars(self), indent=4)
         # Save as latest
-        with open(os.path.join(destination, 'latest.json'), 'w') as outfile:
-            json.dump(self, outfile, cls=vsc.MagicJsonEncoder, indent=4)
+        vsc.Utility.write_if_changed(os.path.join(destination, 'latest.json'), content)
         # Save in the version folder
         for version in self.versions:
-            with open(os.path.join(destination, version["version"], 'extension.json'), 'w') as outfile:
-                json.dump(self, outfile, cls=vsc.MagicJsonEncoder, indent=4)
+            vsc.Utility.write_if_changed(os.path.join(
+                destination, version["version"], 'extension.json'), content)
+
+    @staticmethod
+    def _is_prerelease_version(version):
+        for property in version.get("properties") or []:
+            if property["key"] == "Microsoft.VisualStudio.Code.PreRelease" and property["value"] == "true":
+                return True
+        return False
 
     def isprerelease(self):
-        prerelease = False
-        if "properties" in self.versions[0].keys():
-            for property in self.versions[0]["properties"]:
-                if property["key"] == "Microsoft.VisualStudio.Code.PreRelease" and property["value"] == "true":
-                    prerelease = True
-        return prerelease
+        return self._is_prerelease_version(self.versions[0])
 
     def get_latest_release_versions(self):
         if self.versions and len(self.versions) > 1:
-            releaseVersions = list(filter(lambda x: VSCExtensionVersionDefinition.from_dict(
-                x).isprerelease() == False, self.versions))
-            if(len(releaseVersions) > 0):
-                releaseVersions.sort(
-                    reverse=True, key=lambda x: x["lastUpdated"])
-                latestversion = releaseVersions[0]["version"]
-
-                filteredversions = []
-                for version in releaseVersions:
-                    if version["version"] == latestversion:
-                        filteredversions.append(version)
-
-                return filteredversions
+            latest = max((v for v in self.versions if not self._is_prerelease_version(v)),
+                         key=itemgetter("lastUpdated"), default=None)
+            if latest is not None:
+                latestversion = latest["version"]
+                return [v for v in self.versions
+                        if v["version"] == latestversion and not self._is_prerelease_version(v)]
         return self.versions
 
     def version(self):
@@ -327,28 +454,38 @@ class VSCExtensionDefinition(object):
         return strs
 
 
+def _valid_update_target(platform, architecture, buildtype, quality):
+    if platform == 'win32' and architecture == 'ia32':
+        return False
+    if platform == 'darwin' and (architecture != '' or buildtype != ''):
+        return False
+    if 'linux' in platform and (architecture == '' or buildtype != ''):
+        return False
+    return True
+
+
+# The (platform, architecture, buildtype, quality) combinations the update API serves, built once at import
+UPDATE_TARGETS = tuple(target for target in itertools.product(
+    vsc.PLATFORMS, vsc.ARCHITECTURES, vsc.BUILDTYPES, vsc.QUALITIES) if _valid_update_target(*target))
+
+
 class VSCUpdates(object):
 
     @staticmethod
-    def latest_versions(insider=False):
+    def _check_combination(combination, session):
+        ver = VSCUpdateDefinition(*combination)
+        ver.check_for_update(session)
+        return ver
+
+    @staticmethod
+    def latest_versions(session, insider=False, workers=8):
+        combinations = [target for target in UPDATE_TARGETS if insider or target[3] != 'insider']
         versions = {}
-        for platform in vsc.PLATFORMS:
-            for architecture in vsc.ARCHITECTURES:
-                for buildtype in vsc.BUILDTYPES:
-                    for quality in vsc.QUALITIES:
-                        if quality == 'insider' and not insider:
-                            continue
-                        if platform == 'win32' and architecture == 'ia32':
-                            continue
-                        if platform == 'darwin' and (architecture != '' or buildtype != ''):
-                            continue
-                        if 'linux' in platform and (architecture == '' or buildtype != ''):
-                            continue
-                        ver = VSCUpdateDefinition(
-                            platform, architecture, buildtype, quality)
-                        ver.check_for_update()
-                        log.info(ver)
-                        versions[f'{ver.identity}-{ver.quality}'] = ver
+        # The update checks are independent requests, so run them concurrently
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for ver in executor.map(lambda combination: VSCUpdates._check_combination(combination, session), combinations):
+                log.info(ver)
+                versions[f'{ver.identity}-{ver.quality}'] = ver
         return versions
 
     @staticmethod
@@ -363,23 +500,25 @@ class VSCUpdates(object):
 
 class VSCMarketplace(object):
 
-    def __init__(self, insider, prerelease, version, session):
+    def __init__(self, insider, prerelease, version, session, stop=None):
         self.insider = insider
         self.prerelease = prerelease
         self.version = version
         self.session = session
+        # An optional threading.Event, paged queries end early once it is set
+        self.stop = stop
+        self._base_headers = self._headers()
+        self._searchedbyname = {}
 
     def get_recommendations(self, destination, totalrecommended):
         recommendations = self.search_top_n(totalrecommended)
-        recommended_old = self.get_recommendations_old(destination)
-
-        for extension in recommendations:
-            # If the extension has already been found then prevent it from being collected again when processing the old recommendation list
-            if extension.identity in recommended_old.keys():
-                del recommended_old[extension.identity]
+        # Extensions already found in the top list are not collected again from the old recommendation list
+        recommended_old = sorted((self.get_recommendations_old(destination) or set()) -
+                                 {extension.identity for extension in recommendations})
 
+        found = self.search_by_extension_names(recommended_old)
         for packagename in recommended_old:
-            extension = self.search_by_extension_name(packagename)
+            extension = found.get(packagename)
             if extension:
                 recommendations.append(extension)
             else:
@@ -399,48 +538,55 @@ class VSCMarketplace(object):
         return recommendations
 
     def get_recommendations_old(self, destination):
-        result = self.session.get(vsc.URL_RECOMMENDATIONS,
-                              allow_redirects=True, timeout=vsc.TIMEOUT)
-        if result.status_code != 200:
+        recommendationspath = os.path.join(destination, 'recommendations.json')
+        result = self._conditional_get(vsc.URL_RECOMMENDATIONS, recommendationspath)
+        if result.status_code == 304:
+            jresult = self._load_cached(recommendationspath)
+            if not jresult:
+                return False
+        elif result.status_code != 200:
             log.warning(
                 f"get_recommendations failed accessing url {vsc.URL_RECOMMENDATIONS}, unhandled status code {result.status_code}")
             return False
+        else:
+            jresult = json.loads(result.content)
+            # Keep the body as served rather than re-encoding the parsed json
+            with open(recommendationspath, 'wb') as outfile:
+                outfile.write(result.content)
+            self._save_validators(result, recommendationspath)
 
-        jresult = result.json()
-        with open(os.path.join(destination, 'recommendations.json'), 'w') as outfile:
-            json.dump(jresult, outfile, cls=vsc.MagicJsonEncoder, indent=4)
-
-        # To dict to remove duplicates
-        packages = {}
-        for recommendation in jresult['workspaceRecommendations']:
-            for package in recommendation['recommendations']:
-                packages[package] = None
-
-        return packages
+        # To set to remove duplicates
+        return {package for recommendation in jresult['workspaceRecommendations']
+                for package in recommendation['recommendations']}
 
     def get_malicious(self, destination, extensions=None):
-        result = self.session.get(
-            vsc.URL_MALICIOUS, allow_redirects=True, timeout=vsc.TIMEOUT)
-        if result.status_code != 200:
+        maliciouspath = os.path.join(destination, 'malicious.json')
+        result = self._conditional_get(vsc.URL_MALICIOUS, maliciouspath)
+        if result.status_code == 304:
+            jresult = self._load_cached(maliciouspath)
+            if not jresult:
+                return False
+        elif result.status_code != 200:
             log.warning(
                 f"get_malicious failed accessing url {vsc.URL_MALICIOUS}, unhandled status code {result.status_code}")
             return False
-        # Remove random utf-8 nbsp from server response
-        stripped = result.content.decode(
-            'utf-8', 'ignore').replace(u'\xa0', u'')
-        jresult = json.loads(stripped)
-        with open(os.path.join(destination, 'malicious.json'), 'w') as outfile:
-            json.dump(jresult, outfile, cls=vsc.MagicJsonEncoder, indent=4)
+        else:
+            # Remove random utf-8 nbsp from server response
+            stripped = result.content.decode(
+                'utf-8', 'ignore').translate(_NBSP_TABLE)
+            jresult = json.loads(stripped)
+            with open(maliciouspath, 'w', encoding='utf-8') as outfile:
+                outfile.write(stripped)
+            self._save_validators(result, maliciouspath)
 
         if not extensions:
             return
 
-        for malicious in jresult['malicious']:
-            log.debug(f'Malicious extension {malicious}')
-            if malicious in extensions.keys():
-                log.warning(
-                    f'Preventing malicious extension {malicious} from being downloaded')
-                del extensions[malicious]
+        log.debug(f"Malicious extension list has {len(jresult['malicious'])} entries")
+        for malicious in sorted(extensions.keys() & set(jresult['malicious'])):
+            log.warning(
+                f'Preventing malicious extension {malicious} from being downloaded')
+            del extensions[malicious]
 
     def get_specified(self, specifiedpath):
         if not os.path.exists(specifiedpath):
@@ -457,8 +603,9 @@ class VSCMarketplace(object):
                 specifiedextensions = json.load(fp)
             if specifiedextensions and 'extensions' in specifiedextensions:
                 specified = []
+                found = self.search_by_extension_names(specifiedextensions['extensions'])
                 for packagename in specifiedextensions['extensions']:
-                    extension = self.search_by_extension_name(packagename)
+                    extension = found.get(packagename)
                     if extension:
                         log.info(f'Adding extension to mirror {packagename}')
                         specified.append(extension)
@@ -467,6 +614,45 @@ class VSCMarketplace(object):
                             f'get_custom failed finding a recommended extension by name for {packagename}. This extension has likely been removed.')
                 return specified
 
+    def _conditional_get(self, url, cachepath):
+        """
+        GET a url, sending back the validators the server gave for the cached copy so it can answer 304 if unchanged.
+        Without a cached copy and its validators the GET is unconditional.
+        """
+        headers = {}
+        validators = vsc.Utility.load_json(self._validators_path(cachepath)) if os.path.exists(cachepath) else None
+        if validators:
+            # The server's own values are echoed, so the local clock never decides whether the copy is current
+            if validators.get('ETag'):
+                headers['If-None-Match'] = validators['ETag']
+            if validators.get('Last-Modified'):
+                headers['If-Modified-Since'] = validators['Last-Modified']
+        return self.session.get(url, headers=headers, allow_redirects=True, timeout=vsc.TIMEOUT)
+
+    def _save_validators(self, result, cachepath):
+        validatorspath = self._validators_path(cachepath)
+        validators = {key: result.headers[key] for key in ('ETag', 'Last-Modified') if key in result.headers}
+        if validators:
+            vsc.Utility.write_json(validatorspath, validators)
+        elif os.path.exists(validatorspath):
+            # Stale validators would describe an older copy
+            os.remove(validatorspath)
+
+    @staticmethod
+    def _validators_path(cachepath):
+        folder, name = os.path.split(cachepath)
+        return os.path.join(folder, f'.{name}.validators')
+
+    def _load_cached(self, cachepath):
+        jresult = vsc.Utility.load_json(cachepath)
+        if not jresult:
+            # Remove the unusable copy so the next sync does a full download
+            log.warning(f'Cached copy at {cachepath} is unreadable, removing it')
+            for path in (cachepath, self._validators_path(cachepath)):
+                if os.path.exists(path):
+                    os.remove(path)
+        return jresult
+
     def search_by_text(self, searchtext):
         if searchtext == '*':
             searchtext = ''
@@ -487,30 +673,77 @@ class VSCMarketplace(object):
             return False
 
     def search_by_extension_name(self, extensionname):
+        # Extension packs often share members, so each name is only queried once per sync
+        key = extensionname.lower()
+        if key in self._searchedbyname:
+            return self._searchedbyname[key]
+        extension, ok = self._search_by_extension_name(extensionname)
+        if ok:
+            # A failed query is not remembered as a miss, so the name is tried again when next needed
+            self._searchedbyname[key] = extension
+        return extension
+
+    def _search_by_extension_name(self, extensionname):
+        """
+        Look up an extension by name, returning it (or False) and whether the marketplace answered
+        """
         if self.prerelease:
-            result = self._query_marketplace(
+            result, ok = self._query_marketplace_result(
                 vsc.FilterType.ExtensionName, extensionname)
         else:
-            releaseQueryFlags = vsc.QueryFlags.IncludeFiles | vsc.QueryFlags.IncludeVersionProperties | vsc.QueryFlags.IncludeAssetUri | \
-                vsc.QueryFlags.IncludeStatistics | vsc.QueryFlags.IncludeStatistics | vsc.QueryFlags.IncludeVersions
-            result = self._query_marketplace(
-                vsc.FilterType.ExtensionName, extensionname, queryFlags=releaseQueryFlags)
+            result, ok = self._query_marketplace_result(
+                vsc.FilterType.ExtensionName, extensionname, queryFlags=self._release_query_flags())
             if result and len(result) == 1:
                 result[0].versions = result[0].get_latest_release_versions()
 
         if result and len(result) == 1:
-            return result[0]
+            return result[0], ok
         else:
             #log.debug(f"search_by_extension_name failed {extensionname} got {result}")
-            return False
+            return False, ok
+
+    def search_by_extension_names(self, extensionnames):
+        """
+        Look up several extensions by name in batched marketplace queries, returning a dict of name to extension.
+        A batch whose query failed only contributes what it found, its names are not queried one by one.
+        """
+        extensionnames = list(extensionnames)
+        found = {}
+        for start in range(0, len(extensionnames), EXTENSION_NAME_BATCH_SIZE):
+            batch = extensionnames[start:start + EXTENSION_NAME_BATCH_SIZE]
+            if self.prerelease:
+                result, ok = self._query_marketplace_result(
+                    vsc.FilterType.ExtensionName, batch)
+            else:
+                result, ok = self._query_marketplace_result(
+                    vsc.FilterType.ExtensionName, batch, queryFlags=self._release_query_flags())
+                for extension in result:
+                    extension.versions = extension.get_latest_release_versions()
+
+            # Extension names are matched case insensitively by the marketplace
+            byidentity = {extension.identity.lower(): extension for extension in result}
+            # Seed the per-name lookups, so extension packs referencing these need no further queries
+            for identity, extension in byidentity.items():
+                self._searchedbyname.setdefault(identity, extension)
+            if not ok:
+                # The marketplace has just exhausted its retries, so asking again name by name would only stall the sync
+                log.warning(f'Marketplace lookup failed for {len(batch) - len(byidentity)} of {len(batch)} extension names')
+            for extensionname in batch:
+                if ok:
+                    # A name missing from an answered batch has been removed, remember that rather than asking again
+                    extension = self._searchedbyname.setdefault(
+                        extensionname.lower(), byidentity.get(extensionname.lower(), False))
+                else:
+                    extension = byidentity.get(extensionname.lower())
+                if extension:
+                    found[extensionname] = extension
+        return found
 
     def search_release_by_extension_id(self, extensionid):
         log.debug(
             f'Searching for release candidate by extensionId: {extensionid}')
-        releaseQueryFlags = vsc.QueryFlags.IncludeFiles | vsc.QueryFlags.IncludeVersionProperties | vsc.QueryFlags.IncludeAssetUri | \
-            vsc.QueryFlags.IncludeStatistics | vsc.QueryFlags.IncludeStatistics | vsc.QueryFlags.IncludeVersions
         result = self._query_marketplace(
-            vsc.FilterType.ExtensionId, extensionid, queryFlags=releaseQueryFlags)
+            vsc.FilterType.ExtensionId, extensionid, queryFlags=self._release_query_flags())
         if result and len(result) == 1:
             return result[0]
         else:
@@ -518,54 +751,67 @@ class VSCMarketplace(object):
             return False
 
     def _query_marketplace(self, filtertype, filtervalue, pageNumber=0, pageSize=500, limit=0, sortOrder=vsc.SortOrder.Default, sortBy=vsc.SortBy.NoneOrRelevance, queryFlags=0):
+        return self._query_marketplace_result(filtertype, filtervalue, pageNumber, pageSize, limit, sortOrder, sortBy, queryFlags)[0]
+
+    def _query_marketplace_result(self, filtertype, filtervalue, pageNumber=0, pageSize=500, limit=0, sortOrder=vsc.SortOrder.Default, sortBy=vsc.SortBy.NoneOrRelevance, queryFlags=0):
+        """
+        Query the marketplace, returning the extensions found and whether every page was answered
+        """
         extensions = {}
         total = 0
         count = 0
+        ok = True
 
         if 0 < limit < pageSize:
             pageSize = limit
 
-        while count <= total:
+        while True:
+            if self.stop and self.stop.is_set():
+                # The pages fetched so far are incomplete, so the query is not reported as answered
+                ok = False
+                break
             # log.debug(f'Query marketplace count {count} / total {total} - pagenumber {pageNumber}, pagesize {pageSize}')
             pageNumber = pageNumber + 1
             query = self._query(filtertype, filtervalue,
                                 pageNumber, pageSize, queryFlags)
-            result = None
-            for i in range(10):
-                if i > 0:
-                    log.info("Retrying pull page %d attempt %d." %
-                             (pageNumber, i+1))
-                try:
-                    result = self.session.post(vsc.URL_MARKETPLACEQUERY, headers=self._headers(
-                    ), json=query, allow_redirects=True, timeout=vsc.TIMEOUT)
-                    if result:
-                        break
-                except requests.exceptions.ProxyError:
-                    log.info("ProxyError: Retrying.")
-                except requests.exceptions.ReadTimeout:
-                    log.info("ReadTimeout: Retrying.")
-            if not result:
-                log.info("Failed 10 attempts to query marketplace. Giving up.")
+            # Retries are handled by the session's HTTPAdapter
+            try:
+                result = self.session.post(vsc.URL_MARKETPLACEQUERY, headers=self._base_headers,
+                                           json=query, allow_redirects=False, timeout=vsc.TIMEOUT)
+            except requests.exceptions.RequestException as err:
+                log.info(f"Failed to query marketplace page {pageNumber}. Giving up. {err}")
+                ok = False
+                break
+            # The query endpoint does not redirect, so a 3xx is treated as a failure rather than followed
+            if result.status_code != 200:
+                log.info(f"Failed to query marketplace page {pageNumber}, status code {result.status_code}. Giving up.")
+                ok = False
+                break
+            # Parse the raw bytes directly, json detects the utf encoding itself
+            jresult = json.loads(result.content)
+            if 'results' not in jresult:
+                ok = False
+                break
+            pagecount = 0
+            for jres in jresult['results']:
+                for extension in jres['extensions']:
+                    identity = f"{extension['publisher']['publisherName']}.{extension['extensionName']}"
+                    mpd = VSCExtensionDefinition(
+                        identity=identity, raw=extension)
+                    extensions[identity] = mpd
+                    pagecount = pagecount + 1
+
+                resultmetadata = {resmd['metadataType']: resmd for resmd in jres.get('resultMetadata', ())}
+                if 'ResultCount' in resultmetadata:
+                    total = resultmetadata['ResultCount']['metadataItems'][0]['count']
+            count = len(extensions)
+            # A short page or reaching the reported total means there is nothing left to fetch
+            if pagecount < pageSize or count >= total:
                 break
-            jresult = result.json()
-            count = count + pageSize
-            if 'results' in jresult:
-                for jres in jresult['results']:
-                    for extension in jres['extensions']:
-                        identity = extension['publisher']['publisherName'] + \
-                            '.' + extension['extensionName']
-                        mpd = VSCExtensionDefinition(
-                            identity=identity, raw=extension)
-                        extensions[identity] = mpd
-
-                    if 'resultMetadata' in jres:
-                        for resmd in jres['resultMetadata']:
-                            if 'ResultCount' in resmd['metadataType']:
-                                total = resmd['metadataItems'][0]['count']
             if limit > 0 and count >= limit:
                 break
 
-        return list(extensions.values())
+        return list(extensions.values()), ok
 
     def _query(self, filtertype, filtervalue, pageNumber, pageSize, queryFlags=0):
         if queryFlags == 0:
@@ -591,7 +837,12 @@ class VSCMarketplace(object):
             ]
         }
 
-        if filtervalue != '':
+        if isinstance(filtervalue, list):
+            # Several criteria of the same type match any of the values
+            result['criteria'].extend(
+                self._query_filter_criteria(filtertype, value) for value in filtervalue
+            )
+        elif filtervalue != '':
             result['criteria'].append(
                 self._query_filter_criteria(filtertype, filtervalue)
             )
@@ -609,7 +860,13 @@ class VSCMarketplace(object):
         return vsc.QueryFlags.IncludeFiles | vsc.QueryFlags.IncludeVersionProperties | vsc.QueryFlags.IncludeAssetUri | \
             vsc.QueryFlags.IncludeStatistics | vsc.QueryFlags.IncludeLatestVersionOnly
 
+    def _release_query_flags(self):
+        # All versions are needed to pick the latest release, their properties mark prereleases
+        return vsc.QueryFlags.IncludeFiles | vsc.QueryFlags.IncludeVersionProperties | vsc.QueryFlags.IncludeAssetUri | \
+            vsc.QueryFlags.IncludeStatistics | vsc.QueryFlags.IncludeVersions
+
     def _headers(self):
+        # Built once per instance, so a single user id is used for the whole sync run
         if self.insider:
             insider = '-insider'
         else:
@@ -628,6 +885,67 @@ class VSCMarketplace(object):
         return strs
 
 
+def process_update(version, destination, session):
+    # Only save the reference json if the download was successful
+    if version.download_update(destination, session):
+        version.save_state(destination)
+
+
+def process_extension(extension, destination, mp, session, known):
+    """
+    Download an extension's assets and save its state, returning any extensions it bundles
+    """
+    log.debug(f'Fetching extension: {extension.identity}')
+    extension.download_assets(destination, session)
+    bonus = extension.process_embedded_extensions(destination, mp, known)
+    extension.save_state(destination)
+    return bonus
+
+
+def process_bonus_extension(extension, destination, session):
+    log.debug(f'Processing Embedded Extension: {extension}')
+    extension.download_assets(destination, session)
+    extension.save_state(destination)
+
+
+def task_result(future, task, default=None):
+    """
+    The result of a finished sync task. A failure is logged rather than raised, so one bad
+    extension or installer does not end the rest of the pass.
+    """
+    try:
+        return future.result()
+    except Exception as err:
+        log.warning(f'Failed to sync {task}: {err!r}')
+        return default
+
+
+def completed_tasks(futures, stop, default=None):
+    """
+    Yield each task (the values of futures, keyed by future) with its result as it finishes, see task_result.
+    Ends early once stop is set.
+    """
+    if stop.is_set():
+        return
+    for future in as_completed(futures):
+        if stop.is_set():
+            return
+        yield futures[future], task_result(future, futures[future], default)
+
+
+@contextlib.contextmanager
+def task_pool(workers):
+    """
+    A thread pool that drops its queued tasks when left early (on a stop or an error), only waiting for
+    the tasks already running.
+    """
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        yield executor
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Synchronises VSCode in an Offline Environment')
@@ -665,6 +983,8 @@ if __name__ == '__main__':
                         action='store_true', help='Skip downloading binaries')
     parser.add_argument('--vscode-version', dest='version',
                         default='1.69.2', help='VSCode version to search extensions as.')
+    parser.add_argument('--workers', type=int, dest='workers', default=32,
+                        help='Number of concurrent downloads (extensions and installers), and HTTP connections kept per host. Defaults to 32')
     parser.add_argument('--total-recommended', type=int, dest='totalrecommended', default=500,
                         help='Total number of recommended extensions to sync from Search API. Defaults to 500')
     parser.add_argument('--debug', dest='debug',
@@ -691,10 +1011,10 @@ if __name__ == '__main__':
             level=loglevel
         )
 
-    config.artifactdir_installers = os.path.join(
-        os.path.abspath(config.artifactdir), 'installers')
-    config.artifactdir_extensions = os.path.join(
-        os.path.abspath(config.artifactdir), 'extensions')
+    config.artifactdir = os.path.abspath(config.artifactdir)
+    config.artifactdir_installers = os.path.join(config.artifactdir, 'installers')
+    config.artifactdir_extensions = os.path.join(config.artifactdir, 'extensions')
+    config.specifiedpath = os.path.join(config.artifactdir, 'specified.json')
 
     if config.sync or config.syncall:
         config.checkbinaries = True
@@ -722,44 +1042,74 @@ if __name__ == '__main__':
         config.frequency = timeparse(config.frequency)
 
     session = requests.Session()
+    # Downloads keep a short retry budget, download_assets retries failed transfers itself
     retries = Retry(total=5,
             backoff_factor=0.1,
-            status_forcelist=[ 500, 502, 503, 504 ])
-    session.mount('https://', HTTPAdapter(max_retries=retries))
+            status_forcelist=[ 429, 500, 502, 503, 504 ])
+    # Marketplace queries are POSTs but safe to repeat, and are given longer to ride out rate limiting
+    marketplaceretries = Retry(total=10,
+            backoff_factor=0.5,
+            status_forcelist=[ 429, 500, 502, 503, 504 ],
+            allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {'POST'})
+    # Size the connection pools so every worker can keep its own connection alive
+    adapter = HTTPAdapter(pool_connections=config.workers,
+                          pool_maxsize=config.workers, max_retries=retries)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    # The longest matching prefix wins, so only marketplace requests use the longer budget
+    session.mount(vsc.URL_MARKETPLACEQUERY, HTTPAdapter(pool_connections=config.workers,
+                                                        pool_maxsize=config.workers, max_retries=marketplaceretries))
+
+    # Set by SIGTERM/SIGINT so a sync can stop between downloads instead of being killed mid-transfer.
+    # Only the signal handler sets it and nothing waits on it, so the handler never needs a lock the
+    # interrupted main thread could be holding.
+    stop = threading.Event()
+    stopsignals = []
+
+    def request_stop(signum, frame):
+        stopsignals.append(signum)
+        if len(stopsignals) > 1:
+            # A second signal exits straight away, without waiting for running downloads. Those resume from
+            # their .part files next time, and state files are replaced atomically, so nothing is left half written.
+            log.warning('Stopping immediately')
+            os._exit(128 + signum)
+        log.info('Stop requested, finishing in-flight downloads')
+        stop.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
 
     while True:
         versions = []
         extensions = {}
+        VSCExtensionDefinition.start_sync_cycle()
         mp = VSCMarketplace(config.checkinsider,
-                            config.prerelease, config.version, session)
+                            config.prerelease, config.version, session, stop)
 
-        if config.checkbinaries and not config.skipbinaries:
+        # Each phase is skipped once a stop is requested, so a stopped pass ends as soon as possible
+        if config.checkbinaries and not config.skipbinaries and not stop.is_set():
             log.info('Syncing VS Code Update Versions')
-            versions = VSCUpdates.latest_versions(config.checkinsider)
+            versions = VSCUpdates.latest_versions(session, config.checkinsider)
 
-        if config.updatebinaries and not config.skipbinaries:
+        if config.updatebinaries and not config.skipbinaries and not stop.is_set():
             log.info('Syncing VS Code Binaries')
-            for idkey in versions:
-                if versions[idkey].updateurl:
-                    result = versions[idkey].download_update(
-                        config.artifactdir_installers)
-
-                    # Only save the reference json if the download was successful
-                    if result:
-                        versions[idkey].save_state(
-                            config.artifactdir_installers)
-
-        if config.checkspecified:
+            with task_pool(config.workers) as executor:
+                # Skip updates a previous sync already fetched, rather than re-hashing every installer each cycle
+                futures = {executor.submit(process_update, versions[idkey], config.artifactdir_installers, session): versions[idkey]
+                           for idkey in versions if versions[idkey].updateurl
+                           and not versions[idkey].is_current_on_disk(config.artifactdir_installers)}
+                for _ in completed_tasks(futures, stop):
+                    pass
+
+        if config.checkspecified and not stop.is_set():
             log.info('Syncing VS Code Specified Extensions')
-            specifiedpath = os.path.join(os.path.abspath(
-                config.artifactdir), 'specified.json')
-            specified = mp.get_specified(specifiedpath)
+            specified = mp.get_specified(config.specifiedpath)
             if specified:
                 for item in specified:
                     log.info(item)
                     extensions[item.identity] = item
 
-        if config.extensionsearch:
+        if config.extensionsearch and not stop.is_set():
             log.info(
                 f'Searching for VS Code Extension: {config.extensionsearch}')
             results = mp.search_by_text(config.extensionsearch)
@@ -768,57 +1118,73 @@ if __name__ == '__main__':
                 log.debug(item)
                 extensions[item.identity] = item
 
-        if config.extensionname:
+        if config.extensionname and not stop.is_set():
             log.info(
                 f'Checking Specific VS Code Extension: {config.extensionname}')
             result = mp.search_by_extension_name(config.extensionname)
             if result:
                 extensions[result.identity] = result
 
-        if config.checkextensions:
+        if config.checkextensions and not stop.is_set():
             log.info('Syncing VS Code Recommended Extensions')
-            recommended = mp.get_recommendations(os.path.abspath(
-                config.artifactdir), config.totalrecommended)
+            recommended = mp.get_recommendations(config.artifactdir, config.totalrecommended)
             for item in recommended:
                 extensions[item.identity] = item
 
-        if config.updatemalicious:
+        if config.updatemalicious and not stop.is_set():
             log.info('Syncing VS Code Malicious Extension List')
-            malicious = mp.get_malicious(
-                os.path.abspath(config.artifactdir), extensions)
+            malicious = mp.get_malicious(config.artifactdir, extensions)
 
-        if config.updateextensions:
+        if config.updateextensions and not stop.is_set():
+            total = len(extensions)
             log.info(
-                f'Checking and Downloading Updates for {len(extensions)} Extensions')
+                f'Checking and Downloading Updates for {total} Extensions')
             count = 0
-            bonus = []
-            for identity in extensions:
-                log.debug(f'Fetching extension: {identity}')
-                if count % 100 == 0:
-                    log.info(
-                        f'Progress {count}/{len(extensions)} ({count/len(extensions)*100:.1f}%)')
-                extensions[identity].download_assets(
-                    config.artifactdir_extensions, session)
-                bonus = extensions[identity].process_embedded_extensions(
-                    config.artifactdir_extensions, mp) + bonus
-                extensions[identity].save_state(config.artifactdir_extensions)
-                count = count + 1
-
-            for bonusextension in bonus:
-                log.debug(f'Processing Embedded Extension: {bonusextension}')
-                bonusextension.download_assets(config.artifactdir_extensions, session)
-                bonusextension.save_state(config.artifactdir_extensions)
+            # Embedded extensions that were already synced, or are bundled by more than one pack, are skipped
+            seen = set(extensions)
+            # Pack members that are already being synced need no marketplace lookup
+            known = {extension.identity.lower(): extension for extension in extensions.values()}
+            bonusfutures = {}
+            with task_pool(config.workers) as executor:
+                # Assets are served from per-publisher hosts, so submitting in identity (publisher.name) order
+                # keeps consecutive downloads on the same host and its pooled connections
+                futures = {executor.submit(process_extension, extensions[identity],
+                                           config.artifactdir_extensions, mp, session, known): identity for identity in sorted(extensions)}
+                # Results are gathered on this thread, so the counter and seen set need no locking
+                for identity, bonus in completed_tasks(futures, stop, ()):
+                    count = count + 1
+                    if count % 100 == 0:
+                        log.info('Progress %d/%d (%.1f%%)', count, total, count * 100 / total)
+                    # Queue embedded extensions as soon as they are found, so they overlap the rest of the pass
+                    for bonusextension in bonus:
+                        if bonusextension.identity not in seen:
+                            seen.add(bonusextension.identity)
+                            bonusfutures[executor.submit(process_bonus_extension, bonusextension,
+                                                         config.artifactdir_extensions, session)] = bonusextension.identity
+
+                for _ in completed_tasks(bonusfutures, stop):
+                    pass
+
+        if stop.is_set():
+            # A partial pass is not announced to the gallery
+            log.info('Stopped before the sync completed')
+            break
 
         # Check if we did anything
         if config.checkbinaries or config.checkextensions or config.updatebinaries or config.updateextensions or config.updatemalicious or config.checkspecified or config.checkinsider:
             log.info('Complete')
-            VSCUpdates.signal_updated(os.path.abspath(config.artifactdir))
+            VSCUpdates.signal_updated(config.artifactdir)
 
             # Check if we need to sleep
             if config.frequency:
                 log.info(
                     f'Going to sleep for {vsc.Utility.seconds_to_human_time(config.frequency)}')
-                time.sleep(config.frequency)
+                # Sleep in short steps instead of stop.wait(), which would hold the lock stop.set() needs
+                wakeup = time.monotonic() + config.frequency
+                while not stop.is_set() and time.monotonic() < wakeup:
+                    time.sleep(min(1, wakeup - time.monotonic()))
+                if stop.is_set():
+                    break
             else:
                 break
         else:
@@ -1,8 +1,10 @@
 import datetime
+import fnmatch
 import hashlib
 import json
 import os
 import pathlib
+import sys
 from enum import IntFlag
 from typing import Any, Dict, List, Union
 import logging as log
@@ -11,6 +13,11 @@ PLATFORMS = ["win32", "linux", "linux-deb", "linux-rpm", "darwin", "linux-snap",
 ARCHITECTURES = ["", "x64"]
 BUILDTYPES = ["", "archive", "user"]
 QUALITIES = ["stable", "insider"]
+# The lists above keep their order for building update targets, validation only needs membership
+_PLATFORMS_SET = frozenset(PLATFORMS)
+_ARCHITECTURES_SET = frozenset(ARCHITECTURES)
+_BUILDTYPES_SET = frozenset(BUILDTYPES)
+_QUALITIES_SET = frozenset(QUALITIES)
 
 URL_BINUPDATES = r"https://update.code.visualstudio.com/api/update/"
 URL_RECOMMENDATIONS = r"https://az764295.vo.msecnd.net/extensions/workspaceRecommendations.json.gz"
@@ -77,24 +84,21 @@ class SortOrder(IntFlag):
 
 class MagicJsonEncoder(json.JSONEncoder):
     def default(self, o: Any) -> Union[str, Dict[str, Any]]:
-        try:
-            return super().default(o)
-        except TypeError as err:
-            # could be datetime
-            if isinstance(o, datetime.datetime):
-                return o.isoformat()
-            # could also be cls with slots
-            try:
-                return {key: getattr(o, key, None) for key in o.__slots__}
-            except AttributeError:
-                pass
-            # finally, should have a dict if it is a dataclass or another cls
-            try:
-                return o.__dict__
-            except AttributeError:
-                raise TypeError(
-                    "Can't encode object. Tried isoformat of datetime, class slots and class dict"
-                ) from err
+        # The base encoder only ever raises here, so check the supported types directly
+        # could be datetime
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+        # could also be cls with slots
+        slots = getattr(o, "__slots__", None)
+        if slots is not None:
+            return {key: getattr(o, key, None) for key in slots}
+        # finally, should have a dict if it is a dataclass or another cls
+        attributes = getattr(o, "__dict__", None)
+        if attributes is not None:
+            return attributes
+        raise TypeError(
+            "Can't encode object. Tried isoformat of datetime, class slots and class dict"
+        )
 
 
 class Utility:
@@ -108,10 +112,14 @@ class Utility:
         Hashes a file and checks for the expected checksum.
         Checksum is sha256 default implementation.
         """
+        # Reads are already in large blocks, so skip the extra copy through a BufferedReader
         h = hashlib.sha256()
-        with open(filepath, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                h.update(chunk)
+        with open(filepath, "rb", buffering=0) as f:
+            # Reuse one buffer for every block rather than allocating a new bytes object per read
+            buf = bytearray(1024 * 1024)
+            view = memoryview(buf)
+            while size := f.readinto(buf):
+                h.update(view[:size])
         return expectedchecksum == h.hexdigest()
 
     @staticmethod
@@ -127,43 +135,82 @@ class Utility:
             log.debug(f"Cannot load json at path {filepath.absolute()}. It is a directory")
             return result
 
-        with open(filepath, "r", encoding="utf-8-sig") as fp:
-            try:
-                result = json.load(fp)
-                if not result:
-                    return []
-            except json.decoder.JSONDecodeError as err:
-                log.debug(f"JSONDecodeError while processing {filepath.absolute()} \n error: {str(err)}")
+        with open(filepath, "rb") as fp:
+            data = fp.read()
+        # Parse the raw bytes, json detects the encoding (including a utf-8 bom) itself
+        try:
+            result = json.loads(data)
+            if not result:
                 return []
+        except json.decoder.JSONDecodeError as err:
+            log.debug(f"JSONDecodeError while processing {filepath.absolute()} \n error: {str(err)}")
+            return []
         return result
 
     @staticmethod
     def write_json(filepath: Union[str, pathlib.Path], content: Dict[str, Any]) -> None:
+        # Encode in one pass and write once, json.dump would issue a write for every encoded fragment
+        data = json.dumps(content, cls=MagicJsonEncoder, indent=4)
         with open(filepath, "w") as outfile:
-            json.dump(content, outfile, cls=MagicJsonEncoder, indent=4)
+            outfile.write(data)
+
+    @staticmethod
+    def write_if_changed(filepath: Union[str, pathlib.Path], content: str) -> bool:
+        """
+        Writes content to a file, unless the file already holds exactly that content.
+        The file is replaced atomically, so concurrent readers (e.g. the gallery) never see a partial write.
+        Returns True if the file was written.
+        """
+        try:
+            with open(filepath, "r") as fp:
+                if fp.read() == content:
+                    return False
+        except (FileNotFoundError, UnicodeDecodeError):
+            pass
+        folder, name = os.path.split(filepath)
+        tmppath = os.path.join(folder, f'.{name}.tmp')
+        with open(tmppath, "w") as outfile:
+            outfile.write(content)
+        os.replace(tmppath, filepath)
+        return True
 
     @staticmethod
     def first_file(filepath: Union[str, pathlib.Path], pattern: str, reverse: bool = False) -> Union[str, bool]:
-        if isinstance(filepath, str):
-            filepath = pathlib.Path(filepath)
-        results = [*filepath.glob(pattern)]
-        if not results:
+        if any(char in os.path.dirname(pattern) for char in "*?["):
+            # Wildcards above the last component need every matching directory walked
+            results = sorted(pathlib.Path(filepath).glob(pattern), reverse=reverse)
+            if not results:
+                return False
+            return str(results[0].absolute())
+        # The literal directory part is joined directly, so only the final directory is scanned
+        # and the scan stops at the first match unless the last is wanted
+        folder, pattern = os.path.split(os.path.join(os.path.abspath(filepath), pattern))
+        result = None
+        try:
+            with os.scandir(folder) as it:
+                for entry in it:
+                    if not fnmatch.fnmatchcase(entry.name, pattern):
+                        continue
+                    if not reverse:
+                        return entry.path
+                    if result is None or entry.name > result:
+                        result = entry.name
+        except (FileNotFoundError, NotADirectoryError):
+            return False
+        if result is None:
             return False
-        elif len(results) >= 1 and reverse:
-            results.sort(reverse=True)
-        return str(results[0].absolute())
+        return os.path.join(folder, result)
 
     @staticmethod
     def folders_in_folder(filepath: str) -> List[str]:
-        listing = [f for f in os.listdir(filepath) if os.path.isdir(os.path.join(filepath, f))]
-        listing.sort()
-        return listing
+        # scandir entries carry their type from the directory listing, avoiding a stat per entry
+        with os.scandir(filepath) as it:
+            return sorted(entry.name for entry in it if entry.is_dir())
 
     @staticmethod
     def files_in_folder(filepath: str) -> List[str]:
-        listing = [f for f in os.listdir(filepath) if os.path.isfile(os.path.join(filepath, f))]
-        listing.sort()
-        return listing
+        with os.scandir(filepath) as it:
+            return sorted(entry.name for entry in it if entry.is_file())
 
 
     @staticmethod
@@ -172,20 +219,23 @@ class Utility:
 
     @staticmethod
     def from_json_datetime(jsondate: str) -> datetime.datetime:
+        if sys.version_info >= (3, 11):
+            # fromisoformat parses the trailing Z from Python 3.11, kept naive (utc) as strptime returns it
+            return datetime.datetime.fromisoformat(jsondate).replace(tzinfo=None)
         return datetime.datetime.strptime(jsondate, "%Y-%m-%dT%H:%M:%S.%fZ")
 
     @staticmethod
     def validate_platform(platform: str) -> bool:
-        return platform in PLATFORMS
+        return platform in _PLATFORMS_SET
 
     @staticmethod
     def validate_architecture(arch: str) -> bool:
-        return arch in ARCHITECTURES
+        return arch in _ARCHITECTURES_SET
 
     @staticmethod
     def validate_buildtype(buildtype: str) -> bool:
-        return buildtype in BUILDTYPES
+        return buildtype in _BUILDTYPES_SET
 
     @staticmethod
     def validate_quality(quality: str) -> bool:
-        return quality in QUALITIES
+        return quality in _QUALITIES_SET